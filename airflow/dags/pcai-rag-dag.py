@@ -1,21 +1,24 @@
 """
 =============================================================================
 SIMPLE RAG TEST PIPELINE FOR KNOWLEDGE BASE
-This Airflow DAG runs a mini RAG preprocessing pipeline by checking the input PDF, generating a small set of text chunks, and printing a summary. It demonstrates how tasks pass data through XCom and how intermediate artifacts are saved for reuse. It’s a lightweight end-to-end test of the knowledge-base preparation workflow.
+This Airflow DAG runs a mini RAG preprocessing pipeline by finding the input PDFs, generating a small set of text chunks for each one in parallel, and printing a summary. It demonstrates how tasks pass data through XCom, how one task can fan out over many inputs (dynamic task mapping), and how intermediate artifacts are saved for reuse. It’s a lightweight end-to-end test of the knowledge-base preparation workflow.
 =============================================================================
-This DAG has 3 tasks that run in sequence:
-1. Check if PDF exists
-2. Create 5 sample chunks
-3. Print a summary
+This DAG has 3 tasks:
+1. List the PDFs to process
+2. Create 5 sample chunks - one copy of this task runs PER PDF, in parallel
+3. Print a summary of all PDFs
 
-Tasks share data using XCom (like passing notes)
-Tasks save data to files using Pickle (like freezing data)
+Tasks share data using XCom (like passing notes) - with @task, whatever a
+function returns is pushed to XCom automatically
+Tasks save data to files using Parquet (a compact column-based table format)
 =============================================================================
 """
 
 from airflow import DAG
-from airflow.operators.python import PythonOperator
+from airflow.decorators import task
 from datetime import datetime, timedelta
+import glob
+import itertools
 import sys
 import os
 
@@ -24,11 +27,13 @@ import os
 # ============================================================================
 sys.path.append('/Users/nallagat/playground/at-2/pcai-at-2-rag')  
 
-# Import your RAG components
-from knowledge_base import KnowledgeBase
+# NOTE: RAG components and other heavy libraries are imported INSIDE the task
+# functions. The scheduler re-parses this file constantly; top-level imports
+# would slow down every parse, while imports inside tasks only run on the
+# worker that actually executes the task.
 
-# Where is your PDF?
-PDF_PATH = '/Users/nallagat/playground/at-2/pcai-at-2-rag/data/hpe-pcai.pdf'  
+# Where are your PDFs? (every *.pdf in this folder gets processed)
+PDF_DIR = '/Users/nallagat/playground/at-2/pcai-at-2-rag/data'  
 
 # Where should output files go?
 OUTPUT_DIR = '/Users/nallagat/playground/at-2/pcai-at-2-rag/airflow/test_output'  
@@ -50,7 +55,7 @@ default_args = {
 dag = DAG(
     dag_id='test_rag_simple',           # Name shown in Airflow UI
     default_args=default_args,          # Use settings above
-    description='Simple 3-task test',   # Description
+    description='Simple 3-task test (one chunking task per PDF)',
     schedule=None,                       # Manual trigger only (no auto-run)
     start_date=datetime(2024, 1, 1),   # When this DAG became valid
     catchup=False,                       # Don't run for past dates
@@ -58,80 +63,67 @@ dag = DAG(
 )
 
 # ============================================================================
-# TASK 1: CHECK PDF
+# TASK 1: LIST PDFS
 # ============================================================================
 
-def check_pdf(**context):
+@task
+def list_pdfs():
     """
-    This function checks if the PDF file exists and is readable.
+    This function finds the PDF files to process.
     
     What it does:
-    1. Checks if file exists
-    2. Gets file size
-    3. Saves file size to XCom (so Task 2 can use it)
+    1. Looks for *.pdf files in PDF_DIR
+    2. Fails if there are none
+    3. Returns the list of paths (saved to XCom automatically)
     
-    Args:
-        **context: Airflow automatically passes this. It contains:
-                   - task_instance: Object to push/pull XCom data
-                   - execution_date: When this DAG run started
-                   - And more...
+    Task 2 is "mapped" over this list: Airflow creates one Task 2 instance
+    per PDF, and the executor can run them at the same time.
     """
-    print(f"🔍 Checking PDF: {PDF_PATH}")
+    print(f"🔍 Looking for PDFs in: {PDF_DIR}")
     
-    # Check if file exists
-    if not os.path.exists(PDF_PATH):
-        # If not found, raise error (task will fail and show red in UI)
-        raise FileNotFoundError(f"PDF not found: {PDF_PATH}")
+    pdf_paths = sorted(glob.glob(os.path.join(PDF_DIR, '*.pdf')))
     
-    # Get file size in bytes
-    file_size = os.path.getsize(PDF_PATH)
+    if not pdf_paths:
+        # If not found, raise error (task will fail and show red in UI)
+        raise FileNotFoundError(f"No PDFs found in: {PDF_DIR}")
     
-    # Print results (shows in Airflow logs)
-    print(f"✅ PDF exists")
-    print(f"📦 Size: {file_size / 1024:.2f} KB")  # Convert bytes to KB
+    print(f"✅ Found {len(pdf_paths)} PDF(s)")
+    for pdf_path in pdf_paths:
+        print(f"   - {pdf_path}")
     
     # ========================================================================
-    # XCOM PUSH: Save data for other tasks
+    # XCOM: the return value is the "note" other tasks can read
     # ========================================================================
-    # This is like writing on a sticky note that other tasks can read
-    
-    context['task_instance'].xcom_push(
-        key='file_size',    # Name of the "note" (you can call it anything)
-        value=file_size     # What to write on the note (the number)
-    )
-    
-    # Now other tasks can read this "file_size" note!
-    print(f"💾 Saved file_size to XCom: {file_size}")
+    return pdf_paths
 
 # ============================================================================
-# TASK 2: CREATE SAMPLE CHUNKS
+# TASK 2: CREATE SAMPLE CHUNKS (one instance per PDF)
 # ============================================================================
 
-def create_sample_chunks(**context):
+@task
+def create_sample_chunks(pdf_path):
     """
-    This function loads the PDF and creates 5 sample chunks.
+    This function loads ONE PDF and creates 5 sample chunks.
     
     What it does:
-    1. Reads file_size from Task 1 (XCom pull)
-    2. Loads PDF and creates chunks
-    3. Takes only first 5 chunks (for quick testing)
-    4. Saves chunks to a file (using pickle)
-    5. Saves metadata to XCom (for Task 3)
-    """
-    print(f"📝 Creating sample chunks...")
+    1. Gets file size
+    2. Loads the first pages of the PDF
+    3. Creates only the first 5 chunks (for quick testing)
+    4. Saves chunks to a file (using Parquet)
+    5. Returns ONLY the Parquet file path (XCom, for Task 3)
     
-    # ========================================================================
-    # XCOM PULL: Get data from previous task
-    # ========================================================================
-    # This is like reading the sticky note that Task 1 wrote
+    Args:
+        pdf_path: One entry of the list returned by Task 1
+                  (Airflow fills this in for each mapped instance)
+    """
+    print(f"📝 Creating sample chunks for: {pdf_path}")
     
-    file_size = context['task_instance'].xcom_pull(
-        task_ids='check_pdf',   # Which task wrote the note
-        key='file_size'          # Which note to read
-    )
+    # Get file size in bytes
+    file_size = os.path.getsize(pdf_path)
+    print(f"📦 Size: {file_size / 1024:.2f} KB")  # Convert bytes to KB
     
-    # Now we have the file_size value from Task 1!
-    print(f"📥 Got file_size from Task 1: {file_size / 1024:.2f} KB")
+    # Each PDF gets its own output files so parallel tasks don't clash
+    name = os.path.splitext(os.path.basename(pdf_path))[0]
     
     # ========================================================================
     # Process PDF
@@ -139,39 +131,59 @@ def create_sample_chunks(**context):
     
     print("📚 Loading PDF...")
     
+    # Import your RAG components (only when the task runs, see STEP 1)
+    from knowledge_base import KnowledgeBase
+    
     # Create Knowledge Base object
     kb = KnowledgeBase(
-        pdf_path=PDF_PATH,
+        pdf_path=pdf_path,
         chunk_size=200,      # 200 characters per chunk
         chunk_overlap=50     # 50 characters overlap between chunks
     )
     
-    # Load PDF pages
-    kb.load_pdf_data()
-    
-    # Create all chunks
-    kb.create_chunks()
+    # Start with the first 2 PDF pages - usually plenty for 5 sample chunks.
+    # Cover pages or scans may have no text, so double the page budget until
+    # 5 chunks come back or the whole PDF has been read
+    max_pages = 2
+    while True:
+        kb.load_pdf_data(max_pages=max_pages)
+        
+        # Take only first 5 chunks (for quick testing)
+        # iter_chunks() is a generator, so pages after the 5th chunk are never split
+        sample_chunks = list(itertools.islice(kb.iter_chunks(), 5)) if kb.documents else []
+        if len(sample_chunks) == 5 or max_pages >= kb.page_count:
+            break
+        max_pages *= 2
     
-    # Take only first 5 chunks (for quick testing)
-    sample_chunks = kb.chunks[:5]
+    if not sample_chunks:
+        print("⚠️ Warning: no extractable text found in this PDF")
     
     print(f"✅ Created {len(sample_chunks)} sample chunks")
     
     # ========================================================================
-    # PICKLE: Save chunks to file
+    # PARQUET: Save chunks to file
     # ========================================================================
-    # Pickle = freeze Python objects to disk
     # Why? Because when this task ends, all variables disappear from memory
-    # Pickle lets us save them to disk so Task 3 can load them
+    # Saving to disk lets Task 3 load them
+    # Parquet stores columns (page = int32, chunk = string) instead of a
+    # pickled graph of Python dicts: smaller files, faster to read back,
+    # and loading it can't run arbitrary code like unpickling can
     
-    import pickle
+    import pyarrow as pa
+    import pyarrow.parquet as pq
     
-    # Where to save the pickle file
-    chunks_file = os.path.join(OUTPUT_DIR, 'sample_chunks.pkl')
+    # Where to save the parquet file
+    chunks_file = os.path.join(OUTPUT_DIR, f'{name}_sample_chunks.parquet')
     
     # SAVE chunks to file
-    with open(chunks_file, 'wb') as f:  # 'wb' = write binary mode
-        pickle.dump(sample_chunks, f)    # Freeze chunks to file
+    # The source PDF rides along in the file's metadata, so Task 3 can get
+    # everything it needs from the file itself
+    schema = pa.schema(
+        [('page', pa.int32()), ('chunk', pa.string())],
+        metadata={'source_pdf': pdf_path}
+    )
+    table = pa.Table.from_pylist(sample_chunks, schema=schema)
+    pq.write_table(table, chunks_file)
     
     print(f"💾 Saved chunks to: {chunks_file}")
     
@@ -179,10 +191,11 @@ def create_sample_chunks(**context):
     # Also save human-readable version (text file)
     # ========================================================================
     
-    output_file = os.path.join(OUTPUT_DIR, 'sample_chunks.txt')
+    # Same name as the parquet file, different extension
+    output_file = os.path.splitext(chunks_file)[0] + '.txt'
     
     with open(output_file, 'w') as f:  # Regular text file
-        f.write(f"Sample Chunks from {PDF_PATH}\n")
+        f.write(f"Sample Chunks from {pdf_path}\n")
         f.write("="*70 + "\n\n")
         
         # Write each chunk
@@ -193,80 +206,69 @@ def create_sample_chunks(**context):
     
     print(f"📄 Saved readable version to: {output_file}")
     
+    print("✅ Task 2 complete!")
+    
     # ========================================================================
-    # XCOM PUSH: Save info for Task 3
+    # XCOM: Return info for Task 3
     # ========================================================================
-    
-    context['task_instance'].xcom_push(
-        key='num_chunks',
-        value=len(sample_chunks)
-    )
-    
-    context['task_instance'].xcom_push(
-        key='output_file',
-        value=output_file
-    )
-    
-    context['task_instance'].xcom_push(
-        key='chunks_file',
-        value=chunks_file
-    )
-    
-    print("✅ Task 2 complete!")
+    # Every XCom is a write + read on the Airflow metadata database, so only
+    # the file path is sent - the chunk count, source PDF and text file name
+    # can all be worked out from the Parquet file
+    return chunks_file
 
 # ============================================================================
 # TASK 3: PRINT SUMMARY
 # ============================================================================
 
-def print_summary(**context):
+@task
+def print_summary(chunk_results):
     """
     This function prints a summary of what the pipeline did.
     
     What it does:
-    1. Reads data from Task 2 (XCom pull)
-    2. Optionally loads chunks from pickle file (to demonstrate)
+    1. Reads the Parquet path of every Task 2 instance (XCom)
+    2. Reads details from the Parquet files (to demonstrate)
     3. Prints summary
     4. Saves summary to file
-    """
     
-    # ========================================================================
-    # XCOM PULL: Get data from Task 2
-    # ========================================================================
-    
-    num_chunks = context['task_instance'].xcom_pull(
-        task_ids='create_sample_chunks',
-        key='num_chunks'
-    )
-    
-    output_file = context['task_instance'].xcom_pull(
-        task_ids='create_sample_chunks',
-        key='output_file'
-    )
-    
-    chunks_file = context['task_instance'].xcom_pull(
-        task_ids='create_sample_chunks',
-        key='chunks_file'
-    )
-    
-    print(f"📥 Got data from Task 2:")
-    print(f"   - Number of chunks: {num_chunks}")
-    print(f"   - Output file: {output_file}")
-    print(f"   - Chunks pickle: {chunks_file}")
-    
-    # ========================================================================
-    # OPTIONAL: Load chunks from pickle file (to demonstrate unpickling)
-    # ========================================================================
+    Args:
+        chunk_results: List with one Parquet file path per PDF, returned by Task 2
+    """
     
-    import pickle
+    import pyarrow.parquet as pq
     
-    print(f"\n🔓 Loading chunks from pickle file...")
+    print(f"📥 Got data from {len(chunk_results)} Task 2 instance(s)")
     
-    # LOAD chunks from file
-    with open(chunks_file, 'rb') as f:  # 'rb' = read binary mode
-        chunks = pickle.load(f)          # Unfreeze chunks from file
+    num_chunks_total = 0
+    pdf_lines = []
+    for chunks_file in chunk_results:
+        # ====================================================================
+        # Load chunks from Parquet file (to demonstrate reading it back)
+        # ====================================================================
+        
+        # LOAD chunks from file (memory-mapped, stays an Arrow table)
+        chunks = pq.read_table(chunks_file, memory_map=True)
+        
+        # Everything else comes from the file, not from extra XComs
+        pdf_path = chunks.schema.metadata[b'source_pdf'].decode()
+        num_chunks = chunks.num_rows
+        output_file = os.path.splitext(chunks_file)[0] + '.txt'
+        num_chunks_total += num_chunks
+        
+        print(f"\n📄 {pdf_path}")
+        print(f"   - Number of chunks: {num_chunks}")
+        print(f"   - Output file: {output_file}")
+        print(f"   - Chunks parquet: {chunks_file}")
+        if num_chunks:
+            print(f"   First chunk preview: {chunks.column('chunk')[0].as_py()[:100]}...")
+        
+        pdf_lines.append(
+            f"- {pdf_path}: {num_chunks} chunks\n"
+            f"      Text file: {output_file}\n"
+            f"      Parquet file: {chunks_file}"
+        )
     
-    print(f"✅ Loaded {len(chunks)} chunks from pickle file")
-    print(f"   First chunk preview: {chunks[0]['chunk'][:100]}...")
+    pdf_summary = "\n    ".join(pdf_lines)
     
     # ========================================================================
     # Create summary
@@ -277,22 +279,21 @@ def print_summary(**context):
     🎉 RAG PIPELINE TEST COMPLETED
     {"="*70}
     
-    PDF File: {PDF_PATH}
-    Sample Chunks Created: {num_chunks}
+    PDFs Processed: {len(chunk_results)}
+    Sample Chunks Created: {num_chunks_total}
     
-    Output Files:
-    - Text file: {output_file}
-    - Pickle file: {chunks_file}
+    Per PDF:
+    {pdf_summary}
     
     ✅ All tasks completed successfully!
     
     What we learned:
-    1. Task 1: Checked PDF and saved file_size to XCom
-    2. Task 2: Read file_size, created chunks, saved to pickle
-    3. Task 3: Read metadata, loaded pickle file, printed summary
+    1. Task 1: Listed the PDFs and returned them via XCom
+    2. Task 2: Ran once per PDF (in parallel), saved chunks to Parquet, returned the path
+    3. Task 3: Loaded every Parquet file, printed summary
     
     Next steps:
-    1. Look at the text file to see your chunks
+    1. Look at the text files to see your chunks
     2. Try adding more tasks (embeddings, indexing)
     3. Build the full pipeline!
     
@@ -311,44 +312,27 @@ def print_summary(**context):
     print("✅ Task 3 complete!")
 
 # ============================================================================
-# STEP 3: Create Task Objects
+# STEP 3: Create Tasks and Define Task Order (Dependencies)
 # ============================================================================
-# These are the boxes you see in the Airflow UI
-
-task1 = PythonOperator(
-    task_id='check_pdf',           # ID shown in UI (must be unique)
-    python_callable=check_pdf,     # Which function to run
-    dag=dag,                       # Which DAG this task belongs to
-)
-
-task2 = PythonOperator(
-    task_id='create_sample_chunks',
-    python_callable=create_sample_chunks,
-    dag=dag,
-)
+# Calling a @task function inside the DAG creates the box you see in the
+# Airflow UI. Passing one task's result into another both wires up the XCom
+# AND sets the order - no >> needed.
 
-task3 = PythonOperator(
-    task_id='print_summary',
-    python_callable=print_summary,
-    dag=dag,
-)
-
-# ============================================================================
-# STEP 4: Define Task Order (Dependencies)
-# ============================================================================
-# The >> operator means "then"
-# Read as: "task1 THEN task2 THEN task3"
-
-task1 >> task2 >> task3
+with dag:
+    pdf_paths = list_pdfs()
+    
+    # .expand() = DYNAMIC TASK MAPPING
+    # One create_sample_chunks instance per PDF path, decided at runtime.
+    # The scheduler runs them as independent tasks, in parallel if the
+    # executor has free slots.
+    chunk_results = create_sample_chunks.expand(pdf_path=pdf_paths)
+    
+    # Waits for ALL mapped instances, then gets their results as a list
+    print_summary(chunk_results)
 
 # KNOWLEDGE PURPOSES ONLy
-# Could also write as:
-# task1.set_downstream(task2)
-# task2.set_downstream(task3)
-
-# Or:
-# task3.set_upstream(task2)
-# task2.set_upstream(task1)
+# The same order written with >> would be:
+# list_pdfs >> create_sample_chunks >> print_summary
 
 # ============================================================================
 # END OF DAG
@@ -4,15 +4,62 @@ Requirement: Combine retrieved info with query to enrich input
 Tool: Custom Python string formatting
 """
 
+import io
+
 class Augmentation:
     """
     Enriches query with retrieved context.
     Prepares structured input for generation.
     """
     
-    def __init__(self):
+    def __init__(self, max_chars_per_chunk=500, min_similarity=0.2, dedup=True):
+        """
+        Initialize augmentation component.
+        
+        Shorter prompts = faster LLM generation, so context is compressed:
+        
+        Args:
+            max_chars_per_chunk: Truncate each chunk to this many characters (None = no limit)
+            min_similarity: Drop chunks scoring below this cosine similarity
+            dedup: Skip exact-prefix duplicates (chunks whose first 64 characters
+                   match an earlier chunk's)
+        """
+        self.max_chars_per_chunk = max_chars_per_chunk
+        self.min_similarity = min_similarity
+        self.dedup = dedup
         print("⚡ COMPONENT 4: Augmentation initialized")
     
+    def select(self, retrieved_results):
+        """
+        Keep only the hits that go into the prompt.
+        
+        Drops low-relevance hits and exact-prefix duplicates. Pass the
+        result to both create_context() and Generation so the cited
+        sources match what the LLM saw.
+        
+        Args:
+            retrieved_results: RetrievalResults from retrieval system
+        
+        Returns:
+            RetrievalResults subset
+        """
+        keep = []
+        seen = set()
+        for i, (similarity, chunk) in enumerate(zip(retrieved_results.similarities.tolist(), retrieved_results.chunks)):
+            if similarity < self.min_similarity:
+                continue
+            if self.dedup:
+                key = chunk[:64]
+                if key in seen:
+                    continue
+                seen.add(key)
+            keep.append(i)
+        
+        if len(keep) < len(retrieved_results):
+            print(f"   Dropped {len(retrieved_results) - len(keep)} low-relevance/duplicate chunks")
+            return retrieved_results.take(keep)
+        return retrieved_results
+    
     def create_context(self, query, retrieved_results):
         """
         Combine query with retrieved PDF chunks.
@@ -24,33 +71,31 @@ class Augmentation:
         
         Args:
             query: User's question
-            retrieved_results: List from retrieval system
+            retrieved_results: RetrievalResults already passed through select()
         
         Returns:
             Enriched context string
         """
         print(f"\n⚡ Creating enriched context with {len(retrieved_results)} documents...")
         
-        # Build context from retrieved docs
-        context_parts = []
-        for result in retrieved_results:
-            doc = result['document']
-            context_parts.append(
-                f"[Page {doc['page']}]\n"
-                f"Relevance: {result['similarity']:.2%}\n"
-                f"{doc.get('chunk', '')}\n"
-            )
-        
-        # Combine everything
-        full_context = "\n---\n".join(context_parts)
-        
-        # Create enriched prompt
-        enriched = f"""QUESTION: {query}
-
-RELEVANT CONTEXT FROM PDF:
-{full_context}
-
-INSTRUCTIONS: Answer the question using the context above."""
+        # Write the prompt straight into one buffer (no intermediate strings)
+        buf = io.StringIO()
+        buf.write(f"QUESTION: {query}\n\nRELEVANT CONTEXT FROM PDF:\n")
+        
+        results = zip(
+            retrieved_results.pages.tolist(),
+            retrieved_results.similarities.tolist(),
+            retrieved_results.chunks
+        )
+        for i, (page, similarity, chunk) in enumerate(results):
+            if i:
+                buf.write("\n---\n")
+            if self.max_chars_per_chunk and len(chunk) > self.max_chars_per_chunk:
+                chunk = chunk[:self.max_chars_per_chunk] + "..."
+            buf.write(f"[Page {page}]\nRelevance: {similarity:.2%}\n{chunk}\n")
+        
+        buf.write("\n\nINSTRUCTIONS: Answer the question using the context above.")
+        enriched = buf.getvalue()
         
         print(f"✅ Enriched context created ({len(enriched)} characters)")
-        return enriched
\ No newline at end of file
+        return enriched
@@ -4,6 +4,11 @@ Requirement: Generate response grounded in retrieved knowledge
 Tool: Ollama (local LLM)
 """
 
+import asyncio
+import hashlib
+import threading
+import time
+import httpx
 import ollama
 
 class Generation:
@@ -11,55 +16,134 @@ class Generation:
     Generates final answer from enriched context using Ollama LLM.
     """
     
-    def __init__(self, model_name='llama3.2:3b', use_llm=True):
+    # Ollama connectivity check results shared by all instances: host -> (ok, checked_at)
+    HEALTH_CHECK_TTL = 60  # seconds
+    _health_checks: dict[str, tuple[bool, float]] = {}
+    
+    # Ollama unloads an idle model after 5 minutes by default
+    WARMUP_TTL = 240  # seconds
+    
+    def __init__(self, model_name='llama3.2:3b', use_llm=True, cache_ttl=3600, cache_max_size=128,
+                 host=None, pool_size=20, retries=3, skip_health_check=False):
         """
         Initialize generation component.
         
         Args:
             model_name: Ollama model to use (default: llama3.2:3b)
             use_llm: If False, falls back to template-based generation
+            cache_ttl: Seconds a cached LLM answer stays valid
+            cache_max_size: Max cached answers (oldest evicted first)
+            host: Ollama server URL (default: OLLAMA_HOST or http://localhost:11434)
+            pool_size: Keep-alive HTTP connections kept open to Ollama
+            retries: Connection retries before a request fails
+            skip_health_check: Don't test the Ollama connection on init
         """
         self.model_name = model_name
         self.use_llm = use_llm
+        self.cache_ttl = cache_ttl
+        self.cache_max_size = cache_max_size
+        self._cache: dict[str, tuple[float, str]] = {}  # key -> (created_at, answer)
+        self._cache_lock = threading.Lock()  # generate() runs in worker threads (ask_many_async)
+        self._warmed_up_at = 0.0
+        self._warmup_task = None  # in-flight warm-up shared by concurrent questions
+        
+        # One pooled HTTP client for every request (no new TCP handshake per call).
+        # httpx ignores client-level limits when a transport is given, so they go on the transport.
+        self._client = ollama.Client(
+            host=host,
+            transport=httpx.HTTPTransport(
+                retries=retries,
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            ),
+        )
         
         if use_llm:
             print(f"🤖 COMPONENT 5: Generation initialized (Ollama: {model_name})")
             
             # Test Ollama connection
-            try:
-                ollama.list()
-                print("✅ Ollama connection successful")
-            except Exception as e:
-                print(f"⚠️ Warning: Could not connect to Ollama: {e}")
+            if not skip_health_check and not self._check_connection(str(host)):
                 print("   Make sure Ollama is running: brew services start ollama")
                 print("   Falling back to template mode...")
                 self.use_llm = False
         else:
             print("🤖 COMPONENT 5: Generation initialized (template mode)")
     
+    def _check_connection(self, host_key):
+        """
+        Test the Ollama connection, reusing a recent result for the same host.
+        
+        Every Generation() would otherwise pay a full HTTP round trip
+        (e.g. once per Airflow task instance).
+        """
+        cached = Generation._health_checks.get(host_key)
+        if cached and time.time() - cached[1] < self.HEALTH_CHECK_TTL:
+            ok = cached[0]
+            if not ok:
+                print("⚠️ Warning: Could not connect to Ollama (checked recently)")
+            return ok
+        
+        try:
+            self._client.list()
+            print("✅ Ollama connection successful")
+            ok = True
+        except Exception as e:
+            print(f"⚠️ Warning: Could not connect to Ollama: {e}")
+            ok = False
+        Generation._health_checks[host_key] = (ok, time.time())
+        return ok
+    
     def generate(self, enriched_context, retrieved_results):
         """
         Generate answer from enriched context.
         
+        Synchronous wrapper around generate_stream() for callers that
+        need the full string (notebook, Airflow tasks).
+        
         Args:
             enriched_context: Full prompt with question and context
-            retrieved_results: Original retrieval results (for metadata)
+            retrieved_results: RetrievalResults from retrieval (for metadata)
         
         Returns:
             Generated answer string
         """
+        return "".join(self.generate_stream(enriched_context, retrieved_results))
+    
+    def generate_stream(self, enriched_context, retrieved_results):
+        """
+        Generate answer from enriched context, yielding text as it arrives.
+        
+        With the LLM enabled, tokens are yielded as Ollama produces them so
+        the first words show up long before the full answer is done.
+        
+        Args:
+            enriched_context: Full prompt with question and context
+            retrieved_results: RetrievalResults from retrieval (for metadata)
+        
+        Yields:
+            Pieces of the answer string
+        """
         if self.use_llm:
-            return self._generate_with_llm(enriched_context, retrieved_results)
+            yield from self._generate_with_llm(enriched_context, retrieved_results)
         else:
-            return self._generate_template(enriched_context, retrieved_results)
+            yield self._generate_template(enriched_context, retrieved_results)
     
     def _generate_with_llm(self, enriched_context, retrieved_results):
-        """Generate answer using Ollama LLM."""
+        """Stream answer tokens from Ollama LLM, followed by source citations."""
         print("\n🤖 Generating answer with LLM...")
         
+        # Identical prompt for the same model = identical answer, skip the LLM
+        key = hashlib.sha256(f"{self.model_name}\0{enriched_context}".encode()).hexdigest()
+        with self._cache_lock:
+            cached = self._cache.get(key)
+        if cached and time.time() - cached[0] < self.cache_ttl:
+            print("✅ Answer served from cache")
+            yield cached[1]
+            return
+        
+        parts = []
         try:
-            # Call Ollama
-            response = ollama.chat(
+            # Call Ollama (streaming)
+            stream = self._client.chat(
                 model=self.model_name,
                 messages=[
                     {
@@ -72,30 +156,82 @@ class Generation:
                     'num_predict': 500,      # Max tokens in response
                     'top_k': 40,             # Limits vocabulary consideration
                     'top_p': 0.9,            # Nucleus sampling
-                }
+                },
+                stream=True
             )
             
-            # Extract answer from response
-            answer = response['message']['content']
-            
-            # Add source citations at the end
-            answer += "\n\n" + "="*70
-            answer += "\n📚 SOURCES:\n"
-            answer += "="*70 + "\n"
-            
-            for i, result in enumerate(retrieved_results, 1):
-                doc = result['document']
-                answer += f"\n[{i}] Page {doc['page']} (Similarity: {result['similarity']:.1%})\n"
-                preview = doc['chunk'][:150] + "..." if len(doc['chunk']) > 150 else doc['chunk']
-                answer += f"    Preview: {preview}\n"
-            
-            print("✅ Answer generated successfully with LLM")
-            return answer
+            for chunk in stream:
+                token = chunk['message']['content']
+                parts.append(token)
+                yield token
             
         except Exception as e:
             print(f"❌ LLM generation failed: {e}")
-            print("   Falling back to template mode...")
-            return self._generate_template(enriched_context, retrieved_results)
+            if not parts:
+                print("   Falling back to template mode...")
+                yield self._generate_template(enriched_context, retrieved_results)
+                return
+            # Part of the answer already went out, finish with the sources (not cached)
+            yield "\n\n⚠️ Answer interrupted"
+            yield self._format_sources(retrieved_results)
+            return
+        
+        # Add source citations at the end
+        sources = self._format_sources(retrieved_results)
+        yield sources
+        
+        self._cache_answer(key, "".join(parts) + sources)
+        print("✅ Answer generated successfully with LLM")
+    
+    async def warmup_async(self):
+        """
+        Ask Ollama to load the model into memory without generating anything.
+        
+        Meant to run concurrently with query embedding and retrieval, so the
+        model is resident by the time the real prompt is ready. Only one
+        request is sent per WARMUP_TTL; concurrent callers await the same one.
+        """
+        if not self.use_llm or time.time() - self._warmed_up_at < self.WARMUP_TTL:
+            return
+        task = self._warmup_task
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            task = self._warmup_task = asyncio.create_task(self._warmup())
+        await task
+    
+    async def _warmup(self):
+        """Send the empty chat request that loads the model."""
+        try:
+            # An empty message list just loads the model
+            await asyncio.to_thread(self._client.chat, model=self.model_name, messages=[])
+            self._warmed_up_at = time.time()
+            print(f"✅ Ollama model {self.model_name} warmed up")
+        except Exception as e:
+            print(f"⚠️ Warning: Ollama warm-up failed: {e}")
+    
+    def _format_sources(self, retrieved_results):
+        """Source citations appended after an LLM answer."""
+        sources = "\n\n" + "="*70
+        sources += "\n📚 SOURCES:\n"
+        sources += "="*70 + "\n"
+        
+        results = zip(
+            retrieved_results.pages.tolist(),
+            retrieved_results.similarities.tolist(),
+            retrieved_results.chunks
+        )
+        for i, (page, similarity, chunk) in enumerate(results, 1):
+            sources += f"\n[{i}] Page {page} (Similarity: {similarity:.1%})\n"
+            preview = chunk[:150] + "..." if len(chunk) > 150 else chunk
+            sources += f"    Preview: {preview}\n"
+        return sources
+    
+    def _cache_answer(self, key, answer):
+        """Store an LLM answer, evicting the oldest entries beyond cache_max_size."""
+        with self._cache_lock:
+            self._cache.pop(key, None)  # re-insert so the entry becomes the newest
+            self._cache[key] = (time.time(), answer)
+            while len(self._cache) > self.cache_max_size:
+                self._cache.pop(next(iter(self._cache)), None)
     
     def _generate_template(self, enriched_context, retrieved_results):
         """
@@ -116,12 +252,16 @@ class Generation:
             f"\nFound {len(retrieved_results)} relevant passages:\n\n"
         ]
         
-        for i, result in enumerate(retrieved_results, 1):
-            doc = result['document']
-            preview = doc['chunk'][:300] + "..." if len(doc['chunk']) > 300 else doc['chunk']
+        results = zip(
+            retrieved_results.pages.tolist(),
+            retrieved_results.similarities.tolist(),
+            retrieved_results.chunks
+        )
+        for i, (page, similarity, chunk) in enumerate(results, 1):
+            preview = chunk[:300] + "..." if len(chunk) > 300 else chunk
             
             answer_parts.append(
-                f"[{i}] Page {doc['page']} (Similarity: {result['similarity']:.1%})\n"
+                f"[{i}] Page {page} (Similarity: {similarity:.1%})\n"
                 f"{preview}\n\n"
             )
         
@@ -1,65 +1,161 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from PyPDF2 import PdfReader
+from typing import Optional
 #import re
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+# Heavy dependencies (pypdfium2, langchain, kiru) are imported where they are
+# used, so importing this module (e.g. while Airflow parses a DAG) stays cheap.
+
+# Below this many pages, process start-up costs more than it saves
+PARALLEL_MIN_PAGES = 8
+
+
+def _extract_pages(pdf_path, start, stop):
+    """
+    Extract text for pages [start, stop) of a PDF.
+
+    Module-level so it can run in a worker process; each worker opens
+    its own PDFium document.
+    Returns a list of (page_number, text) tuples (1-based page numbers).
+    """
+    import pypdfium2 as pdfium
+
+    pdf = pdfium.PdfDocument(pdf_path)
+    pages = []
+    try:
+        for i in range(start, stop):
+            page = pdf[i]
+            textpage = page.get_textpage()
+            # PDFium uses CRLF line endings
+            content = textpage.get_text_range().replace("\r\n", "\n")
+            textpage.close()
+            page.close()
+            pages.append((i + 1, content))
+    finally:
+        # Free native PDFium memory
+        pdf.close()
+    return pages
+
 
 class KnowledgeBase:
     """
     Manages PDF documents and creates sentence-preserving chunks for embeddings.
     """
 
-    def __init__(self, pdf_path: str = "data/hpe-pcai.pdf", chunk_size: int = 200, chunk_overlap: int = 50):
+    def __init__(self, pdf_path: str = "data/hpe-pcai.pdf", chunk_size: int = 200, chunk_overlap: int = 50,
+                 use_native_chunker: bool = False):
         """
         pdf_path: Path to PDF file
         chunk_size: Approximate number of words per chunk
         chunk_overlap: Number of overlapping words between consecutive chunks
+        use_native_chunker: Chunk with the Rust kiru library instead of LangChain (if installed)
         """
         self.pdf_path = Path(pdf_path)
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
         self.documents = []
+        self.page_count = 0
         self.chunks = []
+        self._splitter = None
+        self._native_chunker = None
+        self.use_native_chunker = use_native_chunker
+        if use_native_chunker:
+            # Optional Rust-backed chunker (pip install kiru)
+            try:
+                import kiru  # noqa: F401
+            except ImportError:
+                print("⚠️ Warning: kiru is not installed, falling back to LangChain chunking")
+                self.use_native_chunker = False
         print("📚 Knowledge Base initialized")
 
-    def load_pdf_data(self):
-        """Load text content from the PDF"""
+    def load_pdf_data(self, max_pages: Optional[int] = None):
+        """
+        Load text content from the PDF
+        max_pages: Only read the first max_pages pages (default: all pages)
+        """
         if not self.pdf_path.exists():
             raise FileNotFoundError(f"❌ PDF file not found: {self.pdf_path}")
 
+        import pypdfium2 as pdfium
+
         print(f"\n📥 Loading PDF: {self.pdf_path}")
-        reader = PdfReader(str(self.pdf_path))
-        self.documents = []
+        pdf_path = str(self.pdf_path)
+        pdf = pdfium.PdfDocument(pdf_path)
+        num_pages = self.page_count = len(pdf)
+        pdf.close()
+        if max_pages is not None:
+            num_pages = min(num_pages, max_pages)
 
-        for i, page in enumerate(reader.pages):
-            content = page.extract_text() or ""
+        workers = min(os.cpu_count() or 1, num_pages)
+        if num_pages < PARALLEL_MIN_PAGES or workers < 2:
+            pages = _extract_pages(pdf_path, 0, num_pages)
+        else:
+            # Pages decode independently: give each worker a contiguous range
+            print(f"   Extracting {num_pages} pages with {workers} processes...")
+            bounds = [num_pages * w // workers for w in range(workers + 1)]
+            with ProcessPoolExecutor(max_workers=workers) as ex:
+                shards = ex.map(_extract_pages, [pdf_path] * workers, bounds[:-1], bounds[1:])
+                pages = [p for shard in shards for p in shard]
+
+        self.documents = []
+        for page_number, content in sorted(pages):
             if content.strip():
-                self.documents.append({"page": i + 1, "content": content.strip()})
+                self.documents.append({"page": page_number, "content": content.strip()})
 
         print(f"✅ Loaded {len(self.documents)} pages from PDF")
         return self.documents
 
-    def create_chunks(self):
-        """Convert all pages into sentence-preserving chunks"""
+    @property
+    def splitter(self):
+        """Text splitter, built once on first use and reused across calls"""
+        if self._splitter is None:
+            from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+            self._splitter = RecursiveCharacterTextSplitter(
+                chunk_size=self.chunk_size,
+                chunk_overlap=self.chunk_overlap,
+                separators=["\n\n", "\n", ".", "!", "?", " ", ""]
+            )
+        return self._splitter
+
+    def _split_text(self, text):
+        """Split one page of text with the configured chunker"""
+        if self.use_native_chunker:
+            if self._native_chunker is None:
+                from kiru import Chunker
+
+                self._native_chunker = Chunker.by_chars(chunk_size=self.chunk_size, overlap=self.chunk_overlap)
+            return self._native_chunker.on_string(text).all()
+        return self.splitter.split_text(text)
+
+    def iter_chunks(self):
+        """
+        Lazily yield sentence-preserving chunks, one {"page", "chunk"} dict at a time.
+        Pages are only split as far as the caller consumes.
+        """
         if not self.documents:
             raise ValueError("No documents loaded. Call load_pdf_data() first.")
-        
-        print("\n Creating chunks with LangChain RecursiveCharacterTextSplitter...")
-
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=self.chunk_size,
-            chunk_overlap=self.chunk_overlap,
-            separators=["\n\n", "\n", ".", "!", "?", " ", ""]
-        )
-        #Init storage for self.chunks
-        self.chunks = []
+
         # loop through each pdf page
         for d in self.documents:
-            split = splitter.split_text(d["content"])
-            for chunk in split:
-                self.chunks.append({
+            for chunk in self._split_text(d["content"]):
+                yield {
                     "page": d["page"],
                     "chunk": chunk
-                })
+                }
+
+    def create_chunks(self):
+        """Convert all pages into sentence-preserving chunks"""
+        if not self.documents:
+            raise ValueError("No documents loaded. Call load_pdf_data() first.")
+        
+        if self.use_native_chunker:
+            print("\n Creating chunks with kiru native chunker...")
+        else:
+            print("\n Creating chunks with LangChain RecursiveCharacterTextSplitter...")
+
+        self.chunks = list(self.iter_chunks())
 
         print(f"✅ Created {len(self.chunks)} chunks")
         return self.chunks
@@ -0,0 +1,57 @@
+"""
+RAG PIPELINE
+Requirement: Run components 2-5 end to end for a user question
+Tool: asyncio (overlaps embedding + retrieval with LLM warm-up)
+"""
+
+import asyncio
+
+class RAGPipeline:
+    """
+    Answers questions with already-initialized components.
+    
+    The knowledge base must already be encoded and indexed
+    (retrieval.build_index) before asking questions.
+    """
+    
+    def __init__(self, semantic, retrieval, augmentation, generation):
+        """
+        Args:
+            semantic: SemanticLayer used to encode queries
+            retrieval: RetrievalSystem with a built index
+            augmentation: Augmentation used to build the prompt
+            generation: Generation used to produce the answer
+        """
+        self.semantic = semantic
+        self.retrieval = retrieval
+        self.augmentation = augmentation
+        self.generation = generation
+        print("🚀 RAG Pipeline initialized")
+    
+    def ask(self, question, top_k=3):
+        """Answer a question synchronously (notebook / Airflow)."""
+        query_embedding = self.semantic.encode_query(question)
+        results = self.augmentation.select(self.retrieval.search(query_embedding, top_k=top_k))
+        enriched = self.augmentation.create_context(question, results)
+        return self.generation.generate(enriched, results)
+    
+    async def ask_async(self, question, top_k=3):
+        """
+        Answer a question without blocking the event loop (e.g. FastAPI).
+        
+        Ollama loads the model while the query is embedded and searched,
+        instead of only after the prompt is ready. Concurrent questions
+        share one embedding batch.
+        """
+        warmup_task = asyncio.create_task(self.generation.warmup_async())
+        
+        query_embedding = await self.semantic.encode_query_async(question)
+        results = self.augmentation.select(await self.retrieval.search_async(query_embedding, top_k=top_k))
+        enriched = self.augmentation.create_context(question, results)
+        
+        await warmup_task
+        return await asyncio.to_thread(self.generation.generate, enriched, results)
+    
+    async def ask_many_async(self, questions, top_k=3):
+        """Answer several questions concurrently."""
+        return await asyncio.gather(*(self.ask_async(q, top_k=top_k) for q in questions))
@@ -4,17 +4,94 @@ Requirement: Identify and retrieve most relevant documents
 Tool: FAISS (Facebook AI Similarity Search)
 """
 
+import asyncio
+import threading
+from dataclasses import dataclass
+
 import faiss
 import numpy as np
 
+
+@dataclass
+class RetrievalResults:
+    """
+    Top-k search hits stored column-wise (one array per field).
+    
+    Downstream components read the columns directly. Iterating or
+    indexing still yields the old per-hit dicts
+    ({'rank', 'document', 'similarity', 'distance'}) for existing callers.
+    """
+    doc_ids: np.ndarray        # int64[k], positions in RetrievalSystem.documents
+    pages: np.ndarray          # int32[k]
+    similarities: np.ndarray   # float32[k], cosine similarity
+    chunks: list               # str[k]
+    documents: list            # source document dicts, in rank order
+    
+    def __len__(self):
+        return len(self.chunks)
+    
+    def __getitem__(self, i):
+        # Same semantics as the old list of dicts: negative indices, slices -> list
+        if isinstance(i, slice):
+            return [self[j] for j in range(len(self))[i]]
+        i = range(len(self))[i]
+        similarity = float(self.similarities[i])
+        return {
+            'rank': i + 1,
+            'document': self.documents[i],
+            'similarity': similarity,
+            'distance': 1.0 - similarity  # cosine distance
+        }
+    
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+    
+    def take(self, indices):
+        """New RetrievalResults with only the hits at the given positions, in that order."""
+        indices = list(indices)
+        return RetrievalResults(
+            doc_ids=self.doc_ids[indices],
+            pages=self.pages[indices],
+            similarities=self.similarities[indices],
+            chunks=[self.chunks[i] for i in indices],
+            documents=[self.documents[i] for i in indices]
+        )
+
+
 class RetrievalSystem:
     """
     Fast similarity search using FAISS index.
     Retrieves top-k most relevant documents for a query.
     """
     
-    def __init__(self, dimension=384):
+    def __init__(self, dimension=384, index_type='hnsw', hnsw_m=32, ef_construction=200,
+                 ef_search=64, nlist=None, nprobe=16, cache_max_size=256):
+        """
+        Initialize retrieval system.
+        
+        Args:
+            dimension: Embedding dimension (default: 384 for MiniLM)
+            index_type: 'hnsw' (FP32 graph) or 'ivf_sq8' (int8 quantized, ~4x less RAM)
+            hnsw_m: Neighbors per node in the HNSW graph
+            ef_construction: Candidate list size while building the graph
+            ef_search: Candidate list size at query time (higher = better recall, slower)
+            nlist: Number of IVF clusters (default: sqrt(num_docs), clamped to 16-4096)
+            nprobe: IVF clusters visited per query
+            cache_max_size: Max cached query results (0 disables caching)
+        """
+        if index_type not in ('hnsw', 'ivf_sq8'):
+            raise ValueError(f"Unknown index_type: {index_type}")
+        
         self.dimension = dimension
+        self.index_type = index_type
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.cache_max_size = cache_max_size
+        self._cache = {}  # (query bytes, top_k) -> results
+        self._cache_lock = threading.Lock()  # search() runs in worker threads (search_async)
         self.index = None
         self.documents = []
         print(f"🔍 COMPONENT 3: Retrieval System initialized (dim={dimension})")
@@ -26,26 +103,79 @@ class RetrievalSystem:
         FAISS = Facebook AI Similarity Search
         - Industry standard for vector search
         - Fast: can search millions of vectors in milliseconds
+        - HNSW graph: logarithmic-time search instead of a full linear scan
+        - Inner product on L2-normalized vectors = cosine similarity
+        - Optional IVF + int8 scalar quantization for large knowledge bases
         
         Args:
-            embeddings: numpy array (num_docs, 384)
+            embeddings: numpy array (num_docs, 384), float32/float16, or an
+                        (int8 array, scale) tuple from SemanticLayer(output_dtype='int8')
             documents: List of document dictionaries
         """
+        if isinstance(embeddings, tuple):
+            quantized, scale = embeddings
+            embeddings = quantized.astype('float32') / scale
+        
         print(f"\n🔨 Building FAISS index...")
         print(f"   Documents: {len(documents)}")
         print(f"   Embedding shape: {embeddings.shape}")
         
         self.documents = documents
+        with self._cache_lock:
+            self._cache.clear()  # cached results point into the old index
+        
+        # Normalize once so inner product == cosine similarity.
+        # normalize_L2 works in place: copy whenever the array is (or views)
+        # the caller's memory, e.g. a memmapped .npy from encode_documents
+        embeddings_array = np.ascontiguousarray(embeddings, dtype='float32')
+        if isinstance(embeddings, np.ndarray) and np.shares_memory(embeddings_array, embeddings):
+            embeddings_array = np.array(embeddings_array, copy=True)
+        faiss.normalize_L2(embeddings_array)
+        
+        self.index = self._create_index(len(embeddings_array))
         
-        # Create flat L2 index (exact search)
-        self.index = faiss.IndexFlatL2(self.dimension)
+        # IVF needs to learn its cluster centroids first
+        if not self.index.is_trained:
+            self.index.train(embeddings_array)
         
         # Add embeddings to index
-        embeddings_array = np.array(embeddings).astype('float32')
         self.index.add(embeddings_array)
         
         print(f"✅ Index built with {self.index.ntotal} vectors")
     
+    def _create_index(self, num_vectors):
+        """Create an empty inner-product index of the configured type."""
+        if self.index_type == 'ivf_sq8':
+            nlist = self.nlist or min(4096, max(16, int(np.sqrt(num_vectors))))
+            if num_vectors >= nlist:
+                print(f"   Index: IVF + int8 scalar quantizer (nlist={nlist})")
+                quantizer = faiss.IndexFlatIP(self.dimension)
+                return faiss.IndexIVFScalarQuantizer(
+                    quantizer, self.dimension, nlist,
+                    faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+                )
+            print(f"⚠️ Warning: {num_vectors} vectors is too few to train {nlist} IVF clusters")
+            print("   Falling back to HNSW index...")
+        
+        print(f"   Index: HNSW (M={self.hnsw_m})")
+        index = faiss.IndexHNSWFlat(self.dimension, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = self.ef_construction
+        return index
+    
+    def _search_index(self, query_embeddings, top_k):
+        """Normalize a (B, dim) query batch and run one FAISS search over it."""
+        query_array = np.array(query_embeddings, dtype='float32')
+        if query_array.ndim == 1:
+            query_array = query_array.reshape(1, -1)
+        faiss.normalize_L2(query_array)
+        
+        # Search index (scores are already cosine similarities)
+        if isinstance(self.index, faiss.IndexHNSW):
+            self.index.hnsw.efSearch = self.ef_search
+        else:
+            self.index.nprobe = self.nprobe
+        return self.index.search(query_array, top_k)
+    
     def search(self, query_embedding, top_k=3):
         """
         Search for most similar documents.
@@ -55,29 +185,111 @@ class RetrievalSystem:
             top_k: Number of results to return
         
         Returns:
-            List of dicts with document, similarity score, rank
+            RetrievalResults (columnar pages, similarities, chunks; iterates as dicts)
         """
         print(f"\n🔎 Searching for top {top_k} relevant documents...")
         
-        # Ensure correct format
-        query_array = np.array(query_embedding).astype('float32')
-        if query_array.ndim == 1:
-            query_array = query_array.reshape(1, -1)
+        # Repeated identical queries skip FAISS entirely
+        key = (np.asarray(query_embedding, dtype='float32').tobytes(), top_k)
+        with self._cache_lock:
+            cached = self._cache.get(key)
+        if cached is not None:
+            print("✅ Retrieved from cache")
+            return cached
+        
+        scores, indices = self._search_index(query_embedding, top_k)
+        
+        results = self._make_results(indices[0], scores[0])
         
-        # Search index
-        distances, indices = self.index.search(query_array, top_k)
-        
-        # Format results
-        results = []
-        for rank, (idx, distance) in enumerate(zip(indices[0], distances[0]), 1):
-            similarity = 1 / (1 + float(distance))
-            
-            results.append({
-                'rank': rank,
-                'document': self.documents[idx],
-                'similarity': similarity,
-                'distance': float(distance)
-            })
+        if self.cache_max_size:
+            with self._cache_lock:
+                self._cache[key] = results
+                while len(self._cache) > self.cache_max_size:
+                    self._cache.pop(next(iter(self._cache)), None)
         
         print(f"✅ Retrieved {len(results)} documents")
-        return results
\ No newline at end of file
+        return results
+    
+    def _make_results(self, indices, scores):
+        """Build columnar results from one row of FAISS ids/scores."""
+        # -1 = index found fewer than top_k neighbors
+        hits = indices >= 0
+        doc_ids = indices[hits]
+        documents = [self.documents[idx] for idx in doc_ids.tolist()]
+        return RetrievalResults(
+            doc_ids=doc_ids,
+            pages=np.fromiter((doc['page'] for doc in documents), dtype=np.int32, count=len(documents)),
+            similarities=scores[hits],
+            chunks=[doc.get('chunk', '') for doc in documents],
+            documents=documents
+        )
+    
+    async def search_async(self, query_embedding, top_k=3):
+        """
+        Async version of search().
+        
+        FAISS releases the GIL, so running it in a worker thread lets other
+        pipeline steps (e.g. LLM warm-up) proceed on the event loop meanwhile.
+        """
+        return await asyncio.to_thread(self.search, query_embedding, top_k)
+    
+    def _search_queries(self, query_embeddings, top_k):
+        """
+        Validate a (num_queries, dim) query batch and search it with one FAISS call.
+        
+        Shared by search_batch() and search_many().
+        
+        Returns:
+            (scores, indices), each of shape (num_queries, top_k)
+        """
+        query_array = np.asarray(query_embeddings, dtype='float32')
+        if query_array.ndim != 2 or query_array.shape[1] != self.dimension:
+            raise ValueError(
+                f"Expected query embeddings of shape (num_queries, {self.dimension}), "
+                f"got {query_array.shape}"
+            )
+        
+        print(f"\n🔎 Searching {len(query_array)} queries for top {top_k} documents each...")
+        scores, indices = self._search_index(query_array, top_k)
+        print(f"✅ Retrieved results for {len(indices)} queries")
+        return scores, indices
+    
+    def search_batch(self, query_embeddings, top_k=3):
+        """
+        Search for many queries with a single FAISS call.
+        
+        FAISS parallelizes across the batch dimension, so this is much
+        faster than calling search() once per query.
+        
+        Args:
+            query_embeddings: Query vectors (num_queries, 384)
+            top_k: Number of results per query
+        
+        Returns:
+            Dict of columnar arrays, each of shape (num_queries, top_k):
+            'ranks', 'doc_ids' (-1 where no hit) and 'similarities'
+        """
+        scores, indices = self._search_queries(query_embeddings, top_k)
+        return {
+            'ranks': np.broadcast_to(np.arange(1, top_k + 1), indices.shape),
+            'doc_ids': indices,
+            'similarities': scores
+        }
+    
+    def search_many(self, query_embeddings, top_k=3):
+        """
+        Search for many queries at once, returning full results per query.
+        
+        Same single FAISS call as search_batch(); useful for offline
+        evaluation or query expansion where several candidate queries
+        are retrieved together.
+        
+        Args:
+            query_embeddings: Query vectors (num_queries, 384)
+            top_k: Number of results per query
+        
+        Returns:
+            List with one RetrievalResults per query row
+        """
+        scores, indices = self._search_queries(query_embeddings, top_k)
+        return [self._make_results(ids, sims) for ids, sims in zip(indices, scores)]
@@ -1,30 +1,497 @@
 """
 COMPONENT 2: SEMANTIC LAYER
 Requirement: Transform data and queries into semantic representations
-Tool: sentence-transformers (all-MiniLM-L6-v2 model)
+Tool: sentence-transformers (all-MiniLM-L6-v2 model), optionally run with ONNX Runtime,
+      or a Model2Vec static embedding model
 """
 
+import asyncio
+import copy
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import closing
+from itertools import islice
+from pathlib import Path
 from sentence_transformers import SentenceTransformer
 import numpy as np
 
+# Model used when model_name isn't given
+DEFAULT_MODELS = {
+    'torch': 'all-MiniLM-L6-v2',
+    'onnx': 'all-MiniLM-L6-v2',
+    'model2vec': 'minishlab/potion-base-8M',
+}
+
+# Queries used to check that a quantized model still agrees with FP32
+_GOLDEN_TOPICS = (
+    "private cloud AI", "GPU nodes", "support contracts", "software updates",
+    "data storage", "network configuration", "user access", "model deployment",
+    "system monitoring", "hardware installation",
+)
+_GOLDEN_TEMPLATES = (
+    "What is {}?", "How do I configure {}?", "Who provides support for {}?",
+    "What are the requirements for {}?", "Explain the components of {}",
+)
+GOLDEN_QUERIES = tuple(t.format(topic) for topic in _GOLDEN_TOPICS for t in _GOLDEN_TEMPLATES)
+
+# Max allowed drop in mean cosine similarity vs. FP32 (1%)
+QUANTIZATION_TOLERANCE = 0.01
+
+# Fixed int8 scale: normalized embeddings are bounded in [-1, 1]
+INT8_SCALE = 127.0
+
+# model2vec's own StaticModel.encode default, used unless batch_size is set explicitly
+MODEL2VEC_BATCH_SIZE = 1024
+
+# Corpora at least this large get a progress bar (when stderr is a terminal)
+PROGRESS_BAR_MIN_DOCS = 200
+
+# Documents read, encoded and written out per step of encode_documents
+STREAM_WINDOW = 8192
+
+# Document batch sizes timed by SemanticLayer(batch_size='auto')
+BATCH_SIZE_CANDIDATES = (16, 32, 64, 128)
+
+
+def _physical_cores():
+    """Physical CPU cores (hyperthreads don't speed up matmuls)."""
+    try:
+        import psutil
+        return psutil.cpu_count(logical=False) or os.cpu_count() or 1
+    except ImportError:
+        return os.cpu_count() or 1
+
+
+def _l2_normalize(embeddings):
+    """L2-normalize float32 rows in place with one vectorized pass over the array."""
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    np.divide(embeddings, np.maximum(norms, 1e-12, out=norms), out=embeddings)
+    return embeddings
+
+
+def _mean_pool(hidden, attention_mask):
+    """Average (float32) token states over real tokens, as the MiniLM Pooling module does."""
+    mask = attention_mask.unsqueeze(-1).float()
+    return (hidden.float() * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+
+
+def _select_by_keys(db, table, column, keys):
+    """Fetch {key: column} for keys, in groups (SQLite limits the number of query parameters)."""
+    found = {}
+    unique_keys = list(dict.fromkeys(keys))
+    for start in range(0, len(unique_keys), 500):
+        group = unique_keys[start:start + 500]
+        rows = db.execute(
+            f"SELECT key, {column} FROM {table} WHERE key IN ({','.join('?' * len(group))})",
+            group
+        )
+        found.update(rows)
+    return found
+
+
+def _windows(iterable, size):
+    """Yield consecutive lists of up to size items."""
+    iterator = iter(iterable)
+    while window := list(islice(iterator, size)):
+        yield window
+
+
 class SemanticLayer:
     """
     Converts text to dense vector embeddings.
     Uses transformer model to capture semantic meaning.
     """
     
-    def __init__(self, model_name='all-MiniLM-L6-v2'):
-        print("COMPONENT 2: Semantic Layer initializing...")
-        print(f"   Loading model: {model_name}")
-        print("   (First run downloads 22MB - takes 30 seconds)")
+    # Loaded SentenceTransformer models shared by all instances in the process: name -> model
+    _models: dict[str, SentenceTransformer] = {}
+    _models_lock = threading.Lock()
+    
+    def __init__(self, model_name=None, backend='torch', onnx_dir='.onnx_models',
+                 quantize=False, query_cache_size=1024, near_miss_threshold=None, near_miss_window=64,
+                 cache_dir='.emb_cache', output_dtype='float32', batch_size=None, compile=False,
+                 verbose=True, max_query_batch=64, query_batch_wait_ms=10, cache_tokens=False):
+        """
+        Initialize semantic layer.
         
-        # Load pre-trained model
-        self.model = SentenceTransformer(model_name)
-        self.dimension = 384  # MiniLM output dimension
+        Args:
+            model_name: Model to use (default: DEFAULT_MODELS[backend])
+            backend: 'torch' (PyTorch via sentence-transformers),
+                     'onnx' (ONNX Runtime, graph-optimized CPU inference) or
+                     'model2vec' (static token embeddings + mean, no transformer pass:
+                     much faster on CPU at some quality cost - check retrieval hit rate first)
+            onnx_dir: Where the exported ONNX model is kept (export runs once)
+            quantize: Use INT8 dynamic quantization (kept only if it matches FP32 on GOLDEN_QUERIES)
+            query_cache_size: Query embeddings kept in the LRU cache
+            near_miss_threshold: Opt-in: reuse a recent query's vector when cosine >= this
+                                 (None = exact only). Trades accuracy for a RetrievalSystem
+                                 cache hit: the paraphrase is searched with the other
+                                 question's vector, and the encode has already been paid
+            near_miss_window: How many recent query vectors are checked for near misses
+            cache_dir: On-disk cache of document embeddings by chunk hash (None = disabled)
+            output_dtype: Document embedding precision: 'float32', 'float16' (half the
+                          memory, same search quality) or 'int8' (quarter memory)
+            batch_size: Document batch size (None = by device: 256 on CUDA, 16-64 on CPU;
+                        'auto' = time BATCH_SIZE_CANDIDATES on the first encode_documents call;
+                        model2vec uses MODEL2VEC_BATCH_SIZE for both)
+            compile: torch.compile the transformer (torch backend, PyTorch >= 2.0); adds a
+                     one-off compile + warm-up at startup, then cuts per-batch Python overhead
+            verbose: Print progress messages (warnings are always printed)
+            max_query_batch: Most concurrent encode_query_async() calls encoded in one batch
+            query_batch_wait_ms: How long the first query waits for others to join its batch
+            cache_tokens: Also store token IDs of newly encoded chunks in cache_dir (one extra
+                          SQLite write per chunk; later re-encodes, e.g. after switching
+                          quantization, skip the tokenizer). Cached IDs are always used.
+        """
+        if backend not in DEFAULT_MODELS:
+            raise ValueError(f"Unknown backend: {backend}")
+        model_name = model_name or DEFAULT_MODELS[backend]
+        if output_dtype not in ('float32', 'float16', 'int8'):
+            raise ValueError(f"Unknown output_dtype: {output_dtype}")
+        if not (batch_size is None or batch_size == 'auto' or (isinstance(batch_size, int) and batch_size > 0)):
+            raise ValueError(f"Invalid batch_size: {batch_size}")
+        
+        self.verbose = verbose
+        self._log("COMPONENT 2: Semantic Layer initializing...")
+        self._log(f"   Loading model: {model_name} ({backend})")
+        self._log("   (First run downloads 22MB - takes 30 seconds)")
+        
+        self.model_name = model_name
+        self.backend = backend
+        self.onnx_dir = onnx_dir
+        self.cache_dir = cache_dir
+        self.cache_tokens = cache_tokens
+        self.output_dtype = output_dtype
+        
+        # Load pre-trained model (on the GPU in FP16 when CUDA is available)
+        self.device = self._probe_device()
+        if backend == 'onnx':
+            self.model = None
+            self._load_onnx(model_name)
+            self.dimension = self._ort_model.config.hidden_size
+        elif backend == 'model2vec':
+            from model2vec import StaticModel
+            
+            self.model = StaticModel.from_pretrained(model_name)
+            self.dimension = self.model.dim
+        else:
+            self.model = self._get_model(model_name, self.device)
+            self.dimension = self.model.get_sentence_embedding_dimension()
+        self._unnormalized = None  # (model, model without Normalize), see _unnormalized_model
+        
+        # Larger batches raise arithmetic intensity until compute-bound: GPUs
+        # keep gaining up to a few hundred, CPUs flatten out around 16-64.
+        # A static model is a table lookup with no such tradeoff: keep model2vec's own default.
+        self._autotune_batch_size = batch_size == 'auto' and backend != 'model2vec'
+        if backend == 'model2vec' and (batch_size is None or batch_size == 'auto'):
+            batch_size = MODEL2VEC_BATCH_SIZE
+        elif batch_size is None or batch_size == 'auto':
+            batch_size = 256 if self.device == 'cuda' else min(64, max(16, _physical_cores() * 4))
+        self.batch_size = batch_size
+        
+        self.quantized = False
+        if quantize and backend == 'model2vec':
+            print("⚠️ Warning: quantize has no effect on the model2vec backend")
+        elif quantize and self.device == 'cuda':
+            print("⚠️ Warning: INT8 dynamic quantization is CPU-only, using FP16 on the GPU instead")
+        elif quantize:
+            self._quantize()
+        
+        self.compiled = False
+        if compile and backend == 'torch':
+            self._compile()
+        
+        # Direct tokenizer + transformer path for single queries (None = use _encode)
+        self._query_modules = self._single_query_modules()
+        
+        # Query cache: exact LRU on the normalized string + near-miss reuse
+        self.near_miss_threshold = near_miss_threshold
+        self.near_miss_window = near_miss_window
+        self.query_cache_size = query_cache_size
+        self._query_cache: dict[str, bytes] = {}  # normalized query -> float32 vector bytes
+        # Batches are encoded in worker threads while the event loop reads the cache
+        self._query_cache_lock = threading.Lock()
+        self._recent_vectors = np.empty((0, self.dimension), dtype=np.float32)
+        
+        # Coalesces concurrent encode_query_async() calls into one forward pass
+        self._query_batcher = _QueryBatcher(self._encode_query_batch, max_query_batch, query_batch_wait_ms / 1000)
+        
+        self._log(f"✅ Model loaded! Embeddings dimension: {self.dimension}")
+    
+    def _log(self, message):
+        """Print a progress message unless verbose=False."""
+        if self.verbose:
+            print(message)
+    
+    def _probe_device(self):
+        """Device the model runs on ('cuda' or 'cpu'); only the torch backend uses the GPU."""
+        if self.backend != 'torch':
+            return 'cpu'
+        import torch
         
-        print(f"✅ Model loaded! Embeddings dimension: {self.dimension}")
+        return 'cuda' if torch.cuda.is_available() else 'cpu'
     
-    def encode_documents(self, documents):
+    def _tune_batch_size(self, texts, encode=None):
+        """
+        Pick the fastest of BATCH_SIZE_CANDIDATES on a sample of texts.
+        
+        Runs once, on the first corpus large enough to fill the biggest
+        candidate batch twice; the winner is kept in self.batch_size.
+        
+        Args:
+            texts: Items to sample (texts, or token ID arrays for the pretokenized path)
+            encode: encode(items, batch_size) of the loop that will actually run
+                    (default: _encode)
+        """
+        encode = encode or (lambda items, batch_size: self._encode(items, batch_size=batch_size))
+        sample = texts[:2 * max(BATCH_SIZE_CANDIDATES)]
+        if len(sample) < 2 * max(BATCH_SIZE_CANDIDATES):
+            return
+        self._autotune_batch_size = False
+        
+        encode(sample[:min(BATCH_SIZE_CANDIDATES)], min(BATCH_SIZE_CANDIDATES))  # warm-up
+        timings = {}
+        for candidate in BATCH_SIZE_CANDIDATES:
+            start = time.perf_counter()
+            encode(sample, candidate)
+            timings[candidate] = time.perf_counter() - start
+        self.batch_size = min(timings, key=timings.get)
+        self._log(f"   Tuned batch size: {self.batch_size} ({len(sample) / timings[self.batch_size]:.0f} texts/s)")
+    
+    def _load_onnx(self, model_name):
+        """Load (exporting on first use) the model as an ONNX Runtime session."""
+        import onnxruntime as ort
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+        
+        hub_name = model_name if '/' in model_name else f"sentence-transformers/{model_name}"
+        export_dir = Path(self.onnx_dir) / hub_name.replace('/', '__')
+        
+        # Operator fusion, constant folding, layout optimizations
+        sess_options = ort.SessionOptions()
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        sess_options.intra_op_num_threads = _physical_cores()
+        self._onnx_export_dir = export_dir
+        self._ort_session_options = sess_options
+        
+        if (export_dir / 'model.onnx').exists():
+            self._ort_model = self._load_ort_model('model.onnx')
+            self._tokenizer = AutoTokenizer.from_pretrained(export_dir)
+        else:
+            self._log("   Exporting model to ONNX (first run only)...")
+            self._ort_model = ORTModelForFeatureExtraction.from_pretrained(
+                hub_name, export=True, provider="CPUExecutionProvider", session_options=sess_options
+            )
+            self._tokenizer = AutoTokenizer.from_pretrained(hub_name)
+            self._ort_model.save_pretrained(export_dir)
+            self._tokenizer.save_pretrained(export_dir)
+    
+    def _load_ort_model(self, file_name):
+        """Load an ONNX file from the export directory."""
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        
+        return ORTModelForFeatureExtraction.from_pretrained(
+            self._onnx_export_dir, file_name=file_name,
+            provider="CPUExecutionProvider", session_options=self._ort_session_options
+        )
+    
+    @classmethod
+    def _get_model(cls, model_name, device):
+        """
+        Load a SentenceTransformer once per process and share it.
+        
+        Every SemanticLayer() used to read ~90MB of weights and allocate
+        its own copy; instances now reuse the first one. Quantization
+        works on a copy and leaves the shared model untouched. On CUDA
+        the weights are cast to FP16 (half the memory, tensor-core matmuls).
+        """
+        key = f"{model_name}@{device}"
+        with cls._models_lock:
+            model = cls._models.get(key)
+            if model is None:
+                model = SentenceTransformer(model_name, device=device)
+                cls._use_sdpa(model)
+                model.to(device)
+                if device == 'cuda':
+                    model.half()
+                cls._models[key] = model
+            return model
+    
+    @staticmethod
+    def _use_sdpa(model):
+        """
+        Run self-attention through torch's scaled_dot_product_attention.
+        
+        The fused kernel tiles attention instead of materializing the
+        seq x seq score matrix, which matters most for chunks near the
+        256-token limit. Older transformers/PyTorch keep the eager path.
+        """
+        from transformers import AutoModel
+        
+        transformer = model[0]
+        config = transformer.auto_model.config
+        if getattr(config, '_attn_implementation', None) == 'sdpa':
+            return
+        try:
+            # Added with SDPA support in transformers 4.36; also checks torch >= 2.1.1
+            from transformers.utils import is_torch_sdpa_available
+        except ImportError:
+            return
+        # _supports_sdpa says whether this architecture (BERT since 4.41) has an SDPA path at all
+        if not is_torch_sdpa_available() or not getattr(type(transformer.auto_model), '_supports_sdpa', False):
+            return
+        try:
+            transformer.auto_model = AutoModel.from_pretrained(config._name_or_path, attn_implementation='sdpa')
+        except (ImportError, TypeError, ValueError) as e:
+            print(f"⚠️ Warning: SDPA attention unavailable ({e}), using eager attention")
+    
+    def _quantize(self):
+        """
+        Switch to INT8 weights for the Linear/MatMul layers.
+        
+        INT8 matmuls do ~4x the work per cycle of FP32 on VNNI CPUs and
+        halve weight bandwidth. The quantized model is validated against
+        FP32 on GOLDEN_QUERIES and dropped if it drifts too far.
+        """
+        self._log("   Applying INT8 dynamic quantization...")
+        golden = list(GOLDEN_QUERIES)
+        reference = self._encode(golden, batch_size=len(golden))
+        
+        if self.backend == 'onnx':
+            fp32_model = self._ort_model
+            if not (self._onnx_export_dir / 'model_quantized.onnx').exists():
+                from optimum.onnxruntime import ORTQuantizer
+                from optimum.onnxruntime.configuration import AutoQuantizationConfig
+                
+                quantizer = ORTQuantizer.from_pretrained(fp32_model)
+                qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+                quantizer.quantize(save_dir=self._onnx_export_dir, quantization_config=qconfig)
+            self._ort_model = self._load_ort_model('model_quantized.onnx')
+        else:
+            import torch
+            
+            fp32_model = self.model
+            self.model = torch.quantization.quantize_dynamic(fp32_model, {torch.nn.Linear}, dtype=torch.qint8)
+        
+        # Both sets are L2-normalized, so the row-wise dot product is the cosine
+        candidate = self._encode(golden, batch_size=len(golden))
+        agreement = float(np.mean(np.sum(reference * candidate, axis=1)))
+        
+        if agreement < 1 - QUANTIZATION_TOLERANCE:
+            print(f"⚠️ Warning: INT8 model drifted from FP32 (cosine {agreement:.4f}), keeping FP32")
+            if self.backend == 'onnx':
+                self._ort_model = fp32_model
+            else:
+                self.model = fp32_model
+            return
+        
+        self.quantized = True
+        self._log(f"✅ INT8 model validated (cosine vs FP32: {agreement:.4f})")
+    
+    def _compile(self):
+        """
+        Run the transformer through torch.compile.
+        
+        dynamic=True keeps one graph for all sequence lengths and batch
+        sizes instead of recompiling per shape. A warm-up batch pays the
+        compile cost here rather than on the first real request.
+        
+        The compiled transformer goes into a per-instance pipeline that
+        shares the weights; the process-wide model from _get_model() is
+        left untouched for instances created with compile=False.
+        """
+        import torch
+        
+        if not hasattr(torch, 'compile'):
+            print(f"⚠️ Warning: torch.compile needs PyTorch >= 2.0 (found {torch.__version__}), running eager")
+            return
+        
+        self._log("   Compiling transformer with torch.compile...")
+        modules = list(self.model)
+        transformer = copy.copy(modules[0])
+        transformer._modules = transformer._modules.copy()  # own child table, so the shared module keeps its backbone
+        transformer.auto_model = torch.compile(transformer.auto_model, mode="reduce-overhead", dynamic=True)
+        self.model = SentenceTransformer(modules=[transformer, *modules[1:]], device=self.device)
+        self._encode(["warmup"] * 32, batch_size=32)
+        self.compiled = True
+    
+    def _encode_onnx(self, texts, batch_size):
+        """
+        Encode texts with ONNX Runtime: tokenize, run the session,
+        mean-pool over real tokens and L2-normalize (same output as MiniLM).
+        
+        Texts are batched in length order so each batch pads to a similar
+        length, then the rows are put back in input order.
+        """
+        order = np.argsort([len(t) for t in texts], kind='stable')
+        sorted_texts = [texts[i] for i in order]
+        
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            enc = self._tokenizer(
+                sorted_texts[start:start + batch_size],
+                padding=True, truncation=True, max_length=256, return_tensors='np'
+            )
+            hidden = self._ort_model(**enc).last_hidden_state
+            mask = enc['attention_mask'][..., None].astype(np.float32)
+            batches.append((hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None))
+        
+        if not batches:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        embeddings = _l2_normalize(np.concatenate(batches).astype(np.float32))
+        return embeddings[np.argsort(order)]
+    
+    def _encode_model2vec(self, texts, batch_size, show_progress_bar):
+        """Encode texts with the static model: token vector lookup + mean, L2-normalized."""
+        if not texts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        embeddings = self.model.encode(texts, batch_size=batch_size, show_progress_bar=show_progress_bar)
+        return _l2_normalize(np.asarray(embeddings, dtype=np.float32))
+    
+    def _encode(self, texts, batch_size, show_progress_bar=False):
+        """Encode a list of texts to normalized embeddings with the active backend."""
+        if self.backend == 'onnx':
+            return self._encode_onnx(texts, batch_size)
+        if self.backend == 'model2vec':
+            return self._encode_model2vec(texts, batch_size, show_progress_bar)
+        if not texts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        import torch
+        
+        # Autocast keeps precision-sensitive ops (softmax, layer norm) in FP32 on the GPU
+        with torch.autocast('cuda', dtype=torch.float16, enabled=self.device == 'cuda'):
+            embeddings = self._unnormalized_model().encode(
+                texts,
+                batch_size=batch_size,
+                show_progress_bar=show_progress_bar,
+                convert_to_numpy=True,
+                normalize_embeddings=False
+            )
+        # Normalized for cosine similarity: once over the whole result, in FP32
+        return _l2_normalize(embeddings.astype(np.float32, copy=False))
+    
+    def _unnormalized_model(self):
+        """
+        self.model without its trailing Normalize module, if it has one.
+        
+        _encode normalizes the whole result once in NumPy, so the model
+        doesn't also normalize batch by batch. The wrapper shares the
+        model's modules and is rebuilt when self.model is replaced (INT8
+        quantization, torch.compile).
+        """
+        if self._unnormalized is None or self._unnormalized[0] is not self.model:
+            modules = list(self.model)
+            if len(modules) > 1 and type(modules[-1]).__name__ == 'Normalize':
+                encoder = SentenceTransformer(modules=modules[:-1], device=self.device)
+            else:
+                encoder = self.model
+            self._unnormalized = (self.model, encoder)
+        return self._unnormalized[1]
+    
+    def encode_documents(self, documents, out_path=None):
         """
         Convert PDF chunks to embeddings.
         
@@ -32,27 +499,279 @@ class SemanticLayer:
         - Similar meanings = similar vectors
         - Each chunk becomes a 384-d vector
         
+        Documents are consumed STREAM_WINDOW at a time, so only one
+        window of texts is held in memory and each result is written
+        straight into the output.
+        
         Args:
-            documents: List of dicts with 'chunk' or 'content' field
+            documents: List of dicts with 'chunk' or 'content' field, or any
+                       re-creatable iterable of them together with out_path
+                       (build_index needs the documents again afterwards)
+            out_path: Write the embeddings to this .npy file and return it
+                      memory-mapped; required when documents has no len()
         
         Returns:
-            numpy array of shape (num_chunks, 384)
+            numpy array of shape (num_chunks, 384) in output_dtype, with zero
+            rows for empty chunks; for 'int8', a (int8 array, scale) tuple
+            where vector = int8 / scale
         """
-        print(f"\n🔄 Encoding {len(documents)} document chunks to embeddings...")
+        num_docs = len(documents) if hasattr(documents, '__len__') else None
+        if num_docs is None and out_path is None:
+            raise ValueError("documents without len() need an out_path to stream the embeddings to")
+        self._log(f"\n🔄 Encoding {num_docs if num_docs is not None else 'streamed'} document chunks to embeddings...")
         
-        # Extract text content
-        texts = [doc.get('content', doc.get('chunk', '')) for doc in documents]
-
+        dtype = np.int8 if self.output_dtype == 'int8' else np.dtype(self.output_dtype)
+        if num_docs is None:
+            embeddings, skipped = self._encode_unsized(documents, out_path, dtype)
+        else:
+            if out_path is not None:
+                embeddings = np.lib.format.open_memmap(out_path, mode='w+', dtype=dtype, shape=(num_docs, self.dimension))
+            else:
+                embeddings = np.empty((num_docs, self.dimension), dtype=dtype)
+            offset = 0
+            skipped = 0
+            for window in _windows(documents, STREAM_WINDOW):
+                encoded, window_skipped = self._encode_window(window)
+                skipped += window_skipped
+                embeddings[offset:offset + len(window)] = encoded
+                offset += len(window)
+            if out_path is not None:
+                embeddings.flush()
         
-        # Convert to embeddings
-        embeddings = self.model.encode(
-            texts,
-            batch_size=32,
-            show_progress_bar=True,
-            normalize_embeddings=True  # Normalized for cosine similarity
-        )
+        if skipped:
+            self._log(f"   Skipped {skipped} empty chunks")
+        self._log(f"✅ Embeddings created: {embeddings.shape} ({self.output_dtype})")
+        if self.output_dtype == 'int8':
+            return embeddings, INT8_SCALE
+        return embeddings
+    
+    def _encode_unsized(self, documents, out_path, dtype):
+        """
+        Stream an iterable of unknown length into an .npy file.
+        
+        Windows are appended to a raw '<out_path>.part' file as they are
+        encoded; once the row count is known they are copied into the .npy
+        window by window, so RAM never holds more than one window.
+        
+        Returns:
+            (memory-mapped embeddings, number of empty chunks)
+        """
+        part_path = Path(f"{out_path}.part")
+        num_docs = 0
+        skipped = 0
+        with open(part_path, 'wb') as part:
+            for window in _windows(documents, STREAM_WINDOW):
+                encoded, window_skipped = self._encode_window(window)
+                skipped += window_skipped
+                part.write(np.ascontiguousarray(encoded, dtype=dtype).tobytes())
+                num_docs += len(window)
+        
+        try:
+            embeddings = np.lib.format.open_memmap(out_path, mode='w+', dtype=dtype, shape=(num_docs, self.dimension))
+            if num_docs:
+                rows = np.memmap(part_path, dtype=dtype, mode='r', shape=(num_docs, self.dimension))
+                for start in range(0, num_docs, STREAM_WINDOW):
+                    embeddings[start:start + STREAM_WINDOW] = rows[start:start + STREAM_WINDOW]
+                del rows
+            embeddings.flush()
+        finally:
+            part_path.unlink()
+        return embeddings, skipped
+    
+    def _encode_window(self, documents):
+        """
+        Encode one window of documents to output_dtype rows.
+        
+        Returns:
+            (embeddings, number of empty chunks left as zero rows)
+        """
+        # Extract text content; empty chunks are skipped and keep a zero vector
+        keep_idx, texts = [], []
+        for i, doc in enumerate(documents):
+            text = doc.get('content', doc.get('chunk', ''))
+            if text and not text.isspace():
+                keep_idx.append(i)
+                texts.append(text)
+        
+        # Convert to embeddings (unchanged chunks come from the on-disk cache)
+        if self.cache_dir:
+            encoded = self._encode_with_cache(texts)
+        else:
+            encoded = self._encode_corpus(texts)
+        
+        if len(keep_idx) < len(documents):
+            embeddings = np.zeros((len(documents), self.dimension), dtype=np.float32)
+            embeddings[keep_idx] = encoded
+            encoded = embeddings
+        return self._to_output_dtype(encoded), len(documents) - len(keep_idx)
+    
+    def _encode_corpus(self, texts):
+        """Encode document texts in batches of self.batch_size (tuned first if 'auto')."""
+        if self._autotune_batch_size:
+            self._tune_batch_size(texts)
+        return self._encode(texts, batch_size=self.batch_size, show_progress_bar=self._show_progress(len(texts)))
+    
+    def _show_progress(self, count):
+        """tqdm's per-batch stderr writes only pay off for long, interactive runs."""
+        return self.verbose and count >= PROGRESS_BAR_MIN_DOCS and sys.stderr.isatty()
+    
+    def _to_output_dtype(self, embeddings):
+        """Convert normalized float32 embeddings to the configured storage precision."""
+        if self.output_dtype == 'float16':
+            return embeddings.astype(np.float16)
+        if self.output_dtype == 'int8':
+            # int8 @ int8.T (accumulated in int32) / scale**2 approximates the cosine
+            return np.round(embeddings * INT8_SCALE).clip(-127, 127).astype(np.int8)
+        return embeddings
+    
+    def _cache_path(self):
+        """
+        Embedding cache file; each numeric pipeline (model, backend,
+        quantization scheme, GPU FP16 vs CPU FP32) gets its own cache so
+        their vectors are never mixed.
+        """
+        name = self.model_name.replace('/', '__')
+        if self.backend == 'torch':
+            precision = 'dynamic-qint8' if self.quantized else ('fp16' if self.device == 'cuda' else 'fp32')
+        elif self.backend == 'onnx':
+            precision = 'avx512-vnni-int8' if self.quantized else 'fp32'
+        else:
+            precision = 'static'
+        return Path(self.cache_dir) / f"{name}-{self.backend}-{precision}-{self.dimension}.db"
+    
+    def _token_cache_path(self):
+        """Token ID cache file; shared by every precision/quantization of the same model."""
+        name = self.model_name.replace('/', '__')
+        return Path(self.cache_dir) / f"{name}-tokens.db"
+    
+    def _cached_token_ids(self, keys):
+        """Unpadded token IDs of chunks already in the token cache: {key: int32 array}."""
+        with closing(sqlite3.connect(self._token_cache_path())) as db:
+            db.execute("CREATE TABLE IF NOT EXISTS tokens (key BLOB PRIMARY KEY, ids BLOB)")
+            cached = _select_by_keys(db, 'tokens', 'ids', keys)
+        return {key: np.frombuffer(ids, dtype=np.int32) for key, ids in cached.items()}
+    
+    def _store_token_ids(self, texts, keys):
+        """
+        Tokenize chunks and add their IDs to the token cache.
+        
+        IDs are stored as packed int32 under the same chunk hash as the
+        embedding cache, so re-encoding after the embedding cache is
+        invalidated (quantization, backend switch) skips the tokenizer.
+        
+        Returns:
+            {key: int32 array}
+        """
+        tokenizer = self._query_modules[0]
+        encoded = tokenizer(
+            [t.strip() for t in texts], padding=False, truncation=True, max_length=self.model.max_seq_length
+        )['input_ids']
+        token_ids = {key: np.asarray(ids, dtype=np.int32) for key, ids in zip(keys, encoded)}
+        with closing(sqlite3.connect(self._token_cache_path())) as db, db:
+            db.executemany(
+                "INSERT OR REPLACE INTO tokens (key, ids) VALUES (?, ?)",
+                ((key, ids.tobytes()) for key, ids in token_ids.items())
+            )
+        return token_ids
+    
+    def _encode_misses(self, texts, keys):
+        """
+        Encode embedding-cache misses.
+        
+        Chunks whose token IDs are cached skip the tokenizer; the rest go
+        through the normal encode path (and, with cache_tokens=True, get
+        their token IDs stored first).
+        """
+        if self._query_modules is None:
+            return self._encode_corpus(texts)
+        
+        token_ids = self._cached_token_ids(keys)
+        if self.cache_tokens:
+            new_idx = list({keys[i]: i for i in range(len(keys)) if keys[i] not in token_ids}.values())
+            if new_idx:
+                token_ids.update(self._store_token_ids([texts[i] for i in new_idx], [keys[i] for i in new_idx]))
+        
+        pretokenized_idx = [i for i, key in enumerate(keys) if key in token_ids]
+        if len(pretokenized_idx) == len(keys):
+            return self._encode_pretokenized([token_ids[key] for key in keys])
+        
+        embeddings = np.empty((len(texts), self.dimension), dtype=np.float32)
+        if pretokenized_idx:
+            embeddings[pretokenized_idx] = self._encode_pretokenized([token_ids[keys[i]] for i in pretokenized_idx])
+        rest_idx = [i for i, key in enumerate(keys) if key not in token_ids]
+        embeddings[rest_idx] = self._encode_corpus([texts[i] for i in rest_idx])
+        return embeddings
+    
+    def _encode_pretokenized(self, token_ids):
+        """Encode cached token IDs in batches of self.batch_size (tuned first if 'auto')."""
+        if self._autotune_batch_size:
+            self._tune_batch_size(token_ids, encode=self._encode_token_ids)
+        return self._encode_token_ids(token_ids, self.batch_size, show_progress_bar=self._show_progress(len(token_ids)))
+    
+    def _encode_token_ids(self, token_ids, batch_size, show_progress_bar=False):
+        """
+        Encode unpadded token ID arrays, feeding the transformer directly.
+        
+        Batches are formed in length order and padded only to their
+        longest member; output matches _encode (mean pooling + L2 norm).
+        """
+        import torch
+        from tqdm.autonotebook import trange
+        
+        tokenizer, backbone = self._query_modules
+        device = self.model.device
+        
+        order = np.argsort([len(ids) for ids in token_ids], kind='stable')
+        batches = []
+        for start in trange(0, len(order), batch_size, desc="Batches", disable=not show_progress_bar):
+            batch = [token_ids[i] for i in order[start:start + batch_size]]
+            width = max(len(ids) for ids in batch)
+            input_ids = np.full((len(batch), width), tokenizer.pad_token_id, dtype=np.int64)
+            attention_mask = np.zeros((len(batch), width), dtype=np.int64)
+            for row, ids in enumerate(batch):
+                input_ids[row, :len(ids)] = ids
+                attention_mask[row, :len(ids)] = 1
+            
+            input_ids = torch.from_numpy(input_ids).to(device)
+            attention_mask = torch.from_numpy(attention_mask).to(device)
+            with torch.inference_mode(), torch.autocast('cuda', dtype=torch.float16, enabled=self.device == 'cuda'):
+                hidden = backbone(input_ids=input_ids, attention_mask=attention_mask)[0]
+                batches.append(_mean_pool(hidden, attention_mask).cpu().numpy())
+        
+        if not batches:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        return _l2_normalize(np.concatenate(batches)[np.argsort(order)])
+    
+    def _encode_with_cache(self, texts):
+        """
+        Encode texts, reusing vectors of previously seen chunks.
+        
+        Each chunk is keyed by the BLAKE2b-128 hash of its text; only
+        chunks missing from the SQLite store go through the model.
+        """
+        keys = [hashlib.blake2b(t.encode('utf-8'), digest_size=16).digest() for t in texts]
+        embeddings = np.empty((len(texts), self.dimension), dtype=np.float32)
+        
+        path = self._cache_path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(sqlite3.connect(path)) as db:
+            db.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB)")
+            cached = _select_by_keys(db, 'embeddings', 'vector', keys)
+            
+            miss_idx = [i for i, key in enumerate(keys) if key not in cached]
+            for i, key in enumerate(keys):
+                if key in cached:
+                    embeddings[i] = np.frombuffer(cached[key], dtype=np.float32)
+            self._log(f"   Embedding cache: {len(texts) - len(miss_idx)} hits, {len(miss_idx)} to encode")
+            
+            if miss_idx:
+                embeddings[miss_idx] = self._encode_misses([texts[i] for i in miss_idx], [keys[i] for i in miss_idx])
+                with db:
+                    db.executemany(
+                        "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                        ((keys[i], embeddings[i].tobytes()) for i in miss_idx)
+                    )
         
-        print(f"✅ Embeddings created: {embeddings.shape}")
         return embeddings
     
     def encode_query(self, query):
@@ -61,13 +780,205 @@ class SemanticLayer:
         Uses same model so query and documents are in same semantic space.
         
         Args:
-            query: Question string
+            query: Question string, or a list of strings (query expansions,
+                   HyDE pseudo-documents, ...) encoded in one batch
+        
+        Returns:
+            numpy array of shape (1, 384), or (len(query), 384) for a list
+        """
+        if not isinstance(query, str):
+            vectors = self._encode_query_batch(list(query))
+            if not vectors:
+                return np.empty((0, self.dimension), dtype=np.float32)
+            return np.frombuffer(b"".join(vectors), dtype=np.float32).reshape(len(vectors), -1).copy()
+        
+        key = self._query_key(query)
+        vector = self._cached_query(key)
+        if vector is None:
+            vector = self._remember_query(key, self._encode_single(query))
+        return np.frombuffer(vector, dtype=np.float32).reshape(1, -1).copy()
+    
+    async def encode_query_async(self, query):
+        """
+        Convert query to embedding without blocking the event loop.
+        
+        Queries arriving within query_batch_wait_ms of each other are
+        encoded together in one batch instead of queuing on the model
+        one by one; cached queries skip the model entirely.
         
         Returns:
             numpy array of shape (1, 384)
         """
-        embedding = self.model.encode(
-            [query],
-            normalize_embeddings=True
+        key = self._query_key(query)
+        vector = self._cached_query(key)
+        if vector is None:
+            vector = await self._query_batcher.submit(query)
+        return np.frombuffer(vector, dtype=np.float32).reshape(1, -1).copy()
+    
+    @staticmethod
+    def _query_key(query):
+        """Same question typed differently (case/spacing) = same cache entry."""
+        return " ".join(query.lower().split())
+    
+    def _encode_query_batch(self, queries):
+        """
+        Encode queries in one forward pass (cache hits are reused).
+        
+        The cache is keyed by the normalized query, but the model sees
+        the query as typed (first spelling per key in the batch).
+        """
+        keys = [self._query_key(q) for q in queries]
+        vectors = [self._cached_query(key) for key in keys]
+        misses = {}  # key -> query text to encode
+        for key, query, vector in zip(keys, queries, vectors):
+            if vector is None:
+                misses.setdefault(key, query)
+        encoded = {}
+        if misses:
+            batch = self._encode(list(misses.values()), batch_size=len(misses)).astype(np.float32, copy=False)
+            encoded = {key: self._remember_query(key, row) for key, row in zip(misses, batch)}
+        return [vector if vector is not None else encoded[key] for key, vector in zip(keys, vectors)]
+    
+    def _single_query_modules(self):
+        """
+        (tokenizer, transformer) for encoding one query without
+        SentenceTransformer.encode, or None when the model's pipeline isn't
+        plain mean pooling (+ normalize) and the generic path must be used.
+        
+        Callers strip the text like Transformer.tokenize does; models that
+        lowercase in Transformer.tokenize (do_lower_case) use the generic path.
+        """
+        if self.backend != 'torch' or len(self.model) < 2:
+            return None
+        if getattr(self.model[0], 'do_lower_case', False):
+            return None
+        pooling = self.model[1]
+        plain_mean = (
+            getattr(pooling, 'pooling_mode_mean_tokens', False)
+            and not getattr(pooling, 'pooling_mode_cls_token', False)
+            and not getattr(pooling, 'pooling_mode_max_tokens', False)
+            and not getattr(pooling, 'pooling_mode_mean_sqrt_len_tokens', False)
         )
-        return embedding
\ No newline at end of file
+        if not plain_mean or any(type(m).__name__ != 'Normalize' for m in list(self.model)[2:]):
+            return None
+        return self.model.tokenizer, self.model[0].auto_model
+    
+    def _encode_single(self, text):
+        """
+        Encode one text to a normalized float32 vector.
+        
+        For the torch backend this calls the tokenizer and transformer
+        directly, skipping encode()'s batching, sorting and progress-bar
+        setup; the output matches encode(..., normalize_embeddings=True).
+        """
+        if self._query_modules is None:
+            return self._encode([text], batch_size=1)[0].astype(np.float32)
+        import torch
+        import torch.nn.functional as F
+        
+        tokenizer, backbone = self._query_modules
+        enc = tokenizer(text.strip(), truncation=True, max_length=self.model.max_seq_length, return_tensors='pt')
+        enc = {k: v.to(self.model.device) for k, v in enc.items()}
+        with torch.inference_mode():
+            hidden = backbone(**enc)[0]
+            vector = F.normalize(_mean_pool(hidden, enc['attention_mask']), p=2, dim=1)
+        return vector[0].cpu().numpy()
+    
+    def _remember_query(self, key, vector):
+        """
+        Cache a freshly encoded query vector, evicting the oldest entries
+        beyond query_cache_size.
+        
+        With near_miss_threshold set, a vector nearly identical to a recently
+        seen query's is replaced by that query's vector, so the search hits
+        RetrievalSystem's result cache. Only the FAISS search is saved, and
+        the retrieval uses the other question's vector. The LLM answer
+        cache is keyed on the prompt, which contains the question as typed,
+        so paraphrases never hit it.
+        
+        Returns:
+            float32 embedding as bytes
+        """
+        with self._query_cache_lock:
+            result = None
+            if self.near_miss_threshold is not None and len(self._recent_vectors):
+                similarities = self._recent_vectors @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.near_miss_threshold:
+                    result = self._recent_vectors[best].tobytes()
+            
+            if result is None:
+                self._recent_vectors = np.vstack([self._recent_vectors, vector])[-self.near_miss_window:]
+                result = vector.tobytes()
+            
+            if self.query_cache_size:
+                self._query_cache[key] = result
+                while len(self._query_cache) > self.query_cache_size:
+                    self._query_cache.pop(next(iter(self._query_cache)), None)
+            return result
+    
+    def _cached_query(self, key):
+        """Cached vector bytes for a normalized query (marked most recently used), or None."""
+        with self._query_cache_lock:
+            vector = self._query_cache.pop(key, None)
+            if vector is not None:
+                self._query_cache[key] = vector
+            return vector
+
+
+class _QueryBatcher:
+    """
+    Dynamic batcher for concurrent query encoding.
+    
+    The first queued query waits up to max_wait seconds (or until
+    max_batch queries are queued), then the whole batch is encoded in a
+    worker thread and each caller gets its own row back.
+    """
+    
+    def __init__(self, encode_batch, max_batch, max_wait):
+        self.encode_batch = encode_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._loop = None
+        self._queue = None
+        self._worker = None
+    
+    async def submit(self, query):
+        """Queue one query and wait for its vector bytes."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Queues are tied to the event loop that uses them
+            self._loop, self._queue, self._worker = loop, asyncio.Queue(), None
+        
+        future = loop.create_future()
+        self._queue.put_nowait((query, future))
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run())
+        return await future
+    
+    async def _run(self):
+        """Drain the queue batch by batch; exits when it is empty."""
+        loop = asyncio.get_running_loop()
+        while not self._queue.empty():
+            batch = [self._queue.get_nowait()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            
+            queries = [query for query, _ in batch]
+            try:
+                vectors = await asyncio.to_thread(self.encode_batch, queries)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)